@@ -1,20 +1,25 @@
 import argparse
 import json
 import logging
-import copy
+import multiprocessing
 import re
 import os
 import shutil
 import sys
 import hashlib
+import html
+import secrets
 import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime
+import numpy as np
+import orjson
 import pandas as pd
 import pydicom
 from dotenv import load_dotenv
 from pydicom.uid import generate_uid
-from tabulate import tabulate
 from tqdm import tqdm
 
 load_dotenv()
@@ -24,6 +29,36 @@ logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
 SECRET_PEPPER = os.getenv("PEPPER", "default_pepper_if_env_missing")
 
+# Source naming convention: IM-<series>-<image>.dcm
+IM_FILENAME_PATTERN = re.compile(r"IM-(\d+)-(\d+)\.dcm$", re.IGNORECASE)
+
+# Sort key for files that do not follow the naming convention (processed last)
+UNSORTED_INDEX = np.iinfo(np.int64).max
+
+# Replacement values for 'Z' actions, by VR
+VR_DEFAULTS = {
+    'DA': "", 'TM': "", 'DT': "",
+    'PN': "ANONYMIZED", 'AS': "000Y", 'CS': "U", 'DS': "0",
+    'IS': "0", 'LO': "ANONYMIZED", 'SH': "ANONYMIZED",
+    'ST': "ANONYMIZED", 'LT': "ANONYMIZED", 'UT': "ANONYMIZED", 'AE': "ANONYMIZED",
+}
+
+HTML_TABLE_HEAD = (
+    "<table>\n<thead>\n"
+    "<tr><th>TAG</th><th>ACT</th><th>STATUS</th><th>ORIGINAL</th><th>ANON</th></tr>\n"
+    "</thead>\n<tbody>\n"
+)
+
+# Column order of every audit row (a plain tuple); the summary report appends 'File'.
+REPORT_COLUMNS = ("Tag", "Action", "Status", "Original", "Anonymized")
+
+
+@lru_cache(maxsize=1024)
+def _hash_with_pepper(original_id):
+    # A batch almost always belongs to a single patient, so this is hashed once per worker.
+    combined_string = str(original_id) + SECRET_PEPPER
+    return hashlib.sha256(combined_string.encode('utf-8')).hexdigest()
+
 
 def get_base_path():
     if getattr(sys, 'frozen', False):
@@ -40,14 +75,33 @@ def get_internal_path(relative_path):
     return Path(__file__).resolve().parent / relative_path
 
 
+# --- WORKER PROCESS STATE ---
+# Each pool worker receives its own copy of the anonymizer once, at start-up.
+_worker_anonymizer = None
+_worker_args = None
+
+
+def _init_worker(anonymizer, args):
+    global _worker_anonymizer, _worker_args
+    _worker_anonymizer = anonymizer
+    _worker_args = args
+
+
+def _process_one(job):
+    index, item, series_uid = job
+    return _worker_anonymizer._process_file(item, index, series_uid, _worker_args)
+
+
 class AnonymDICOM:
     def __init__(self, input_source, profile_path, output_folder, remove_private_tags=True, show_actions=False):
         self.input_files = input_source
         self.output_folder = Path(output_folder)
         self.remove_private = remove_private_tags
         self.show_actions = show_actions
-        self.uid_map = {}
-        self.audit_log = []
+        # Salts the derived replacement UIDs: unique per execution, reproducible within it
+        self.uid_salt = secrets.token_hex(16)
+        # Columnar audit log (one list per report column) for the summary report
+        self.audit_log = {column: [] for column in (*REPORT_COLUMNS, "File")}
         self.rules = self._load_profile(profile_path)
         self.pesel_number = ""
 
@@ -58,6 +112,13 @@ class AnonymDICOM:
         # Placeholder for Series UID (will be set in the loop)
         self.batch_series_uid = None
 
+        # 'X' is not dispatched: removals are deferred until a dataset's walk is done
+        self._actions = {
+            'U': self._replace_uid,
+            'Z': self._replace_value,
+            'D': self._replace_value,
+        }
+
     def _load_profile(self, path):
         with open(path, 'r', encoding='utf-8') as f:
             rules = json.load(f)
@@ -68,71 +129,79 @@ class AnonymDICOM:
             return rules
 
     def _generate_hashed_id(self, original_id):
-        combined_string = str(original_id) + SECRET_PEPPER
-        return hashlib.sha256(combined_string.encode('utf-8')).hexdigest()
+        return _hash_with_pepper(original_id)
 
     def _generate_consistent_uid(self, original_uid):
-        if original_uid not in self.uid_map:
-            self.uid_map[original_uid] = generate_uid()
-        return self.uid_map[original_uid]
+        # Pure function of the original UID, so independent worker processes agree on
+        # the replacement without sharing a map. 2.25 is the UUID-derived UID root.
+        h = hashlib.sha256((str(original_uid) + self.uid_salt).encode('utf-8')).hexdigest()
+        return '2.25.' + str(int(h[:32], 16))
 
     def _get_replacement_value(self, vr, action):
         if action == 'D': return ""
-        static_defaults = {
-            'DA': "", 'TM': "", 'DT': "",
-            'PN': "ANONYMIZED", 'AS': "000Y", 'CS': "U", 'DS': "0",
-            'IS': "0", 'LO': "ANONYMIZED", 'SH': "ANONYMIZED",
-            'ST': "ANONYMIZED", 'LT': "ANONYMIZED", 'UT': "ANONYMIZED", 'AE': "ANONYMIZED",
-        }
-        return generate_uid() if vr == 'UI' else static_defaults.get(vr, "ANONYMIZED")
+        return generate_uid() if vr == 'UI' else VR_DEFAULTS.get(vr, "ANONYMIZED")
+
+    # --- PROFILE ACTIONS ---
+    def _replace_uid(self, dataset, elem, action):
+        if elem.value:
+            gen_uid = self._generate_consistent_uid
+            if elem.VM > 1:
+                elem.value = [gen_uid(u) for u in elem.value]
+            else:
+                elem.value = gen_uid(elem.value)
 
-    def _process_dataset_recursive(self, dataset):
-        if self.remove_private:
-            try:
-                dataset.remove_private_tags()
-            except:
-                pass
+    def _replace_value(self, dataset, elem, action):
+        elem.value = self._get_replacement_value(elem.VR, action)
 
-        for elem in list(dataset):
+    def _process_dataset_recursive(self, dataset):
+        # Bound once per dataset; this loop runs for every element of every file
+        rules_get = self.rules.get
+        actions_get = self._actions.get
+        study_uid = self.batch_study_uid
+        series_uid = self.batch_series_uid
+        show_actions = self.show_actions
+        removed = []
+
+        for elem in dataset:
             keyword = elem.keyword
             if not keyword: continue
 
             # --- MANDATORY OVERRIDES ---
             # 1. Force the Directory-wide Study UID
             if keyword == "StudyInstanceUID":
-                elem.value = self.batch_study_uid
+                elem.value = study_uid
                 continue
 
             # 2. Force the current Series UID
             if keyword == "SeriesInstanceUID":
-                if self.batch_series_uid:
-                    elem.value = self.batch_series_uid
+                if series_uid:
+                    elem.value = series_uid
                 continue
 
+            action = rules_get(keyword)
+
             # --- SEQUENCE HANDLING ---
             if elem.VR == 'SQ':
-                if keyword in self.rules and self.rules[keyword] == 'X':
-                    delattr(dataset, keyword)
+                if action == 'X':
+                    removed.append(elem.tag)
                 else:
                     for item in elem.value: self._process_dataset_recursive(item)
                 continue
 
             # --- STANDARD PROFILE RULES ---
-            if keyword in self.rules:
-                action = self.rules[keyword]
-                if self.show_actions:
-                    print(f"Processing tag from config: {keyword} (Action: {action})")
+            if action is None: continue
+            if show_actions:
+                print(f"Processing tag from config: {keyword} (Action: {action})")
+            if action == 'X':
+                removed.append(elem.tag)
+                continue
 
-                if action == 'X':
-                    delattr(dataset, keyword)
-                elif action == 'U':
-                    if elem.value:
-                        if elem.VM > 1:
-                            elem.value = [self._generate_consistent_uid(u) for u in elem.value]
-                        else:
-                            elem.value = self._generate_consistent_uid(elem.value)
-                elif action in ['Z', 'D']:
-                    elem.value = self._get_replacement_value(elem.VR, action)
+            handler = actions_get(action)
+            if handler:
+                handler(dataset, elem, action)
+
+        for tag in removed:
+            del dataset[tag]
         return dataset
 
     def _finalize_metadata(self, dataset, index):
@@ -150,43 +219,46 @@ class AnonymDICOM:
     def _compare_files_internal(self, ds_orig, ds_anon, filename):
         diffs = []
         self._compare_recursive(ds_orig, ds_anon, diffs, path="ROOT")
-        for item in diffs:
-            item['File'] = filename
-            self.audit_log.append(item)
-        return len([d for d in diffs if "FAIL" in d['Status']]), diffs
+        return len([d for d in diffs if "FAIL" in d[2]]), diffs
 
     def _compare_recursive(self, ds_in, ds_out, results, path=""):
+        rules_get = self.rules.get
+        append = results.append
         for elem in ds_in:
             keyword = elem.keyword
             if not keyword: continue
+            action = rules_get(keyword)
+            is_sequence = elem.VR == 'SQ'
+            # Not covered by the profile and nothing to descend into: no row, no str() calls
+            if action is None and not is_sequence: continue
+
             current_path = f"{path}.{keyword}" if path != "ROOT" else keyword
             elem_out = ds_out.get(elem.tag) if ds_out else None
-            val_orig, val_anon = str(elem.value), str(elem_out.value) if elem_out else "MISSING"
 
-            if elem.VR == 'SQ':
-                if keyword in self.rules and self.rules[keyword] == 'X':
+            if is_sequence:
+                if action == 'X':
                     status = "OK" if elem_out is None else "FAIL (Should delete)"
-                    results.append({"Tag": current_path, "Action": "X (Seq)", "Status": status, "Original": "Seq",
-                                    "Anonymized": val_anon})
+                    append((current_path, "X (Seq)", status, "Seq", str(elem_out.value) if elem_out else "MISSING"))
                 elif elem_out and elem.value:
+                    items_out = elem_out.value
                     for i, item_orig in enumerate(elem.value):
-                        if i < len(elem_out.value):
-                            self._compare_recursive(item_orig, elem_out.value[i], results, f"{current_path}[{i}]")
-            elif keyword in self.rules:
-                action, status = self.rules[keyword], "OK"
-                if keyword in ["StudyInstanceUID", "SeriesInstanceUID"]:
-                    status = "OK"
-                elif action == 'X':
-                    status = "FAIL (Leak)" if (elem_out is not None and val_anon != "") else "OK"
-                elif action == 'D':
-                    status = "FAIL (Not Empty)" if val_anon != "" else "OK"
-                elif action == 'Z':
-                    status = "FAIL (No Change)" if (
-                            str(elem.value) == str(elem_out.value) and str(elem.value) != "") else "OK"
-                elif action == 'U':
-                    status = "FAIL (UID match)" if str(elem.value) == str(elem_out.value) else "OK"
-                results.append({"Tag": current_path, "Action": action, "Status": status, "Original": val_orig,
-                                "Anonymized": val_anon})
+                        if i < len(items_out):
+                            self._compare_recursive(item_orig, items_out[i], results, f"{current_path}[{i}]")
+                continue
+
+            val_orig, val_anon = str(elem.value), str(elem_out.value) if elem_out else "MISSING"
+            status = "OK"
+            if keyword in ("StudyInstanceUID", "SeriesInstanceUID"):
+                pass
+            elif action == 'X':
+                status = "FAIL (Leak)" if (elem_out is not None and val_anon != "") else "OK"
+            elif action == 'D':
+                status = "FAIL (Not Empty)" if val_anon != "" else "OK"
+            elif action == 'Z':
+                status = "FAIL (No Change)" if (val_orig == val_anon and val_orig != "") else "OK"
+            elif action == 'U':
+                status = "FAIL (UID match)" if val_orig == val_anon else "OK"
+            append((current_path, action, status, val_orig, val_anon))
 
     def _save_individual_reports(self, diffs, base_filename, args):
         file_id = Path(base_filename).stem
@@ -194,24 +266,66 @@ class AnonymDICOM:
         if args.json_report:
             jd = self.output_folder / "reports_json"
             jd.mkdir(parents=True, exist_ok=True)
-            with open(jd / f"{file_id}.json", 'w', encoding='utf-8') as f:
-                json.dump(diffs, f, indent=4, ensure_ascii=False)
+            records = [dict(zip(REPORT_COLUMNS, d), File=base_filename) for d in diffs]
+            with open(jd / f"{file_id}.json", 'wb') as f:
+                f.write(orjson.dumps(records, option=orjson.OPT_INDENT_2))
 
         if args.html_report:
             hd = self.output_folder / "reports_html"
             hd.mkdir(parents=True, exist_ok=True)
-            rows = [[d['Tag'], d['Action'], d['Status'], d['Original'][:40], d['Anonymized'][:40]] for d in diffs]
-            table = tabulate(rows, headers=["TAG", "ACT", "STATUS", "ORIGINAL", "ANON"], tablefmt="html")
+            # Tag paths, actions and statuses are keywords/fixed strings; only the values need escaping
+            rows = ''.join(
+                f"<tr><td>{tag}</td><td>{action}</td><td>{status}</td>"
+                f"<td>{html.escape(original[:40])}</td><td>{html.escape(anonymized[:40])}</td></tr>\n"
+                for tag, action, status, original, anonymized in diffs)
             with open(hd / f"{file_id}.html", 'w', encoding='utf-8') as f:
-                f.write(f"<html><body><h2>Report: {file_id}</h2>{table}</body></html>")
+                f.write(f"<html><body><h2>Report: {file_id}</h2>{HTML_TABLE_HEAD}{rows}</tbody>\n</table></body></html>")
+
+    def _output_filename(self, item, index):
+        if item['is_pattern']:
+            return f"AN-{item['series_str']}-{item['image_str']}.dcm"
+        padding = len(str(len(self.input_files)))
+        study_prefix = self.batch_study_uid.split('.')[-1][-6:]
+        return f"ST_{study_prefix}_{index:0{padding}}.dcm"
+
+    def _process_file(self, item, index, series_uid, args):
+        """Anonymizes a single file and returns (audit rows, output filename). Runs inside a pool worker."""
+        file_path = item['path']
+        self.batch_series_uid = series_uid
+        try:
+            ds = pydicom.dcmread(file_path)
+            self.pesel_number = str(ds.get("PatientID", ""))
+            # Untouched metadata-only copy for the audit comparison
+            ds_orig = pydicom.dcmread(file_path, stop_before_pixels=True)
+
+            # Once per file: pydicom walks into every sequence item itself
+            if self.remove_private:
+                try:
+                    ds.remove_private_tags()
+                except:
+                    pass
+            self._process_dataset_recursive(ds)
+            self._finalize_metadata(ds, index)
+
+            new_filename = self._output_filename(item, index)
+            ds.save_as(self.output_folder / new_filename)
+
+            _, diffs = self._compare_files_internal(ds_orig, ds, new_filename)
+            return diffs, new_filename
+
+        except Exception as e:
+            logging.error(f"Error processing {file_path}: {e}")
+            return [], None
 
     def _check_comparison(self, dataset):
         dicom_keywords = sorted([elem.keyword for elem in dataset if elem.keyword])
-        config_keywords = set(self.rules.keys())
 
-        common = sorted([k for k in dicom_keywords if k in config_keywords])
-        only_dicom = sorted([k for k in dicom_keywords if k not in config_keywords])
-        only_config = sorted(config_keywords - set(dicom_keywords))
+        # Single pass over the already sorted keywords
+        rules = self.rules
+        common, only_dicom = [], []
+        for k in dicom_keywords:
+            (common if k in rules else only_dicom).append(k)
+        only_config = sorted(rules.keys() - set(dicom_keywords))
 
         print("\n" + "="*50)
         print("DICOM TAG vs CONFIG PROFILE COMPARISON")
@@ -241,17 +355,17 @@ class AnonymDICOM:
 
         # Prepare files with sorting
         file_data = []
-        pattern = re.compile(r"IM-(\d+)-(\d+)\.dcm$", re.IGNORECASE)
+        match_filename = IM_FILENAME_PATTERN.search
 
         for f in self.input_files:
             # ... (rest of the run method preparation)
-            match = pattern.search(f.name)
+            match = match_filename(f.name)
             if match:
                 s_str, i_str = match.groups()
                 file_data.append({
                     'path': f,
-                    'series_sort': int(s_str),
-                    'image_sort': int(i_str),
+                    'series_sort': min(int(s_str), UNSORTED_INDEX),
+                    'image_sort': min(int(i_str), UNSORTED_INDEX),
                     'series_str': s_str,
                     'image_str': i_str,
                     'is_pattern': True
@@ -259,62 +373,56 @@ class AnonymDICOM:
             else:
                 file_data.append({
                     'path': f,
-                    'series_sort': float('inf'),
-                    'image_sort': float('inf'),
+                    'series_sort': UNSORTED_INDEX,
+                    'image_sort': UNSORTED_INDEX,
                     'series_str': "NON_PATTERN",
                     'image_str': "0000",
                     'is_pattern': False
                 })
 
         # Sort the files so we process them in order (Series 1, Series 2...)
-        file_data.sort(key=lambda x: (x['series_sort'], x['image_sort']))
+        # np.lexsort is stable and sorts by the last key first: series, then image.
+        count = len(file_data)
+        series = np.fromiter((d['series_sort'] for d in file_data), dtype=np.int64, count=count)
+        image = np.fromiter((d['image_sort'] for d in file_data), dtype=np.int64, count=count)
+        file_data = [file_data[i] for i in np.lexsort((image, series))]
 
         if args.comparison and file_data:
             first_ds = pydicom.dcmread(file_data[0]['path'])
             self._check_comparison(first_ds)
 
-        current_series_key = None
-
-        # Prepare naming convention
-        padding = len(str(len(self.input_files)))
-        study_prefix = self.batch_study_uid.split('.')[-1][-6:]
-        
-        total_files = len(file_data)
-        for index, item in enumerate(file_data, 1):
-            # Machine-readable progress output
-            sys.stderr.write(f"::PROGRESS::{index}/{total_files}::Anonymizing\n")
-            sys.stderr.flush()
-
-            file_path = item['path']
-            try:
-                # --- SERIES UID LOGIC ---
-                # Checks if the Series Identifier (XXXX in IM-XXXX-YYYY) has changed
-                if item['series_str'] != current_series_key:
-                    self.batch_series_uid = generate_uid()
-                    current_series_key = item['series_str']
-                # ------------------------
-
-                ds = pydicom.dcmread(file_path)
-                self.pesel_number = str(ds.get("PatientID", ""))
-                ds_orig = copy.deepcopy(ds)
-
-                self._process_dataset_recursive(ds)
-                self._finalize_metadata(ds, index)
-
-                if item['is_pattern']:
-                    new_filename = f"AN-{item['series_str']}-{item['image_str']}.dcm"
-                else:
-                    new_filename = f"ST_{study_prefix}_{index:0{padding}}.dcm"
-
-                ds.save_as(self.output_folder / new_filename)
-
-                _, diffs = self._compare_files_internal(ds_orig, ds, new_filename)
-                self._save_individual_reports(diffs, new_filename, args)
-
-            except Exception as e:
-                logging.error(f"Error processing {file_path}: {e}")
-
-        if self.audit_log and args.summary_report:
+        # --- SERIES UID LOGIC ---
+        # One Series UID per Series Identifier (XXXX in IM-XXXX-YYYY), assigned up
+        # front so every file can be processed independently.
+        series_uids = {}
+        for item in file_data:
+            if item['series_str'] not in series_uids:
+                series_uids[item['series_str']] = generate_uid()
+
+        jobs = [(index, item, series_uids[item['series_str']]) for index, item in enumerate(file_data, 1)]
+        total_files = len(jobs)
+
+        # Per-file reports are written on a thread pool, overlapping with the workers
+        write_reports = args.json_report or args.html_report
+        report_jobs = []
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_worker,
+                                 initargs=(self, args)) as executor, ThreadPoolExecutor(max_workers=4) as io_pool:
+            for index, (diffs, new_filename) in enumerate(executor.map(_process_one, jobs, chunksize=8), 1):
+                # Machine-readable progress output
+                sys.stderr.write(f"::PROGRESS::{index}/{total_files}::Anonymizing\n")
+                sys.stderr.flush()
+                if new_filename and write_reports:
+                    report_jobs.append(io_pool.submit(self._save_individual_reports, diffs, new_filename, args))
+                if diffs:
+                    for column, values in zip(REPORT_COLUMNS, zip(*diffs)):
+                        self.audit_log[column].extend(values)
+                    self.audit_log["File"].extend([new_filename] * len(diffs))
+
+        for job in report_jobs:
+            if job.exception():
+                logging.error(f"Error writing reports: {job.exception()}")
+
+        if self.audit_log["File"] and args.summary_report:
             pd.DataFrame(self.audit_log).to_excel(self.output_folder / "SUMMARY_REPORT.xlsx", index=False)
 
 
@@ -358,4 +466,5 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
@@ -7,4 +7,13 @@ STATUS_SIGNED = 7
 
 # Environment Variables
 SECRET_PEPPER = os.getenv("SECRET_PEPPER")
-SERVER_API_KEY = os.getenv("API_KEY")
\ No newline at end of file
+SERVER_API_KEY = os.getenv("API_KEY")
+
+# Upstream services (read once at import; they do not change per request)
+PACS_PROXY_URL = os.getenv("PACS_PROXY_URL", "http://pacs-proxy:8080").rstrip('/')
+RIS_API_URL = os.getenv("RIS_API_URL", "http://apiserver:8000/app/api").rstrip('/')
+ANONYMIZER_API_KEY = os.getenv("ANONYMIZER_API_KEY", "")
+ANONYMIZER_HEADERS = {"X-Anonymizer-Key": ANONYMIZER_API_KEY}
+INTERNAL_AUTH_SHARED_SECRET = os.getenv("INTERNAL_AUTH_SHARED_SECRET")
+# Bulk token endpoint (GET /referrals/tokens/) on the RIS; off until the RIS serves it
+RIS_BULK_TOKENS = os.getenv("RIS_BULK_TOKENS", "false").lower() == "true"
@@ -0,0 +1,27 @@
+import asyncio
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+
+import httpx
+
+MAX_CONNECTIONS = 100
+# Connections left for one-off calls (RIS lookups, series lists, single-instance proxying)
+RESERVED_CONNECTIONS = 20
+
+# Shared app-lifetime HTTP client for the PACS proxy and RIS calls.
+# Reuses pooled keep-alive connections across requests instead of a new TCP handshake per call.
+# http2 only takes effect for https:// upstreams (negotiated via TLS ALPN); the plain http://
+# PACS proxy and RIS URLs of this deployment use HTTP/1.1. Closed by the lifespan handler in main.py.
+# The client is shared by every caller, so its cookie jar accepts nothing: a Set-Cookie from an
+# upstream (e.g. a session cookie) must not be replayed on other users' requests.
+http_client = httpx.AsyncClient(
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=50),
+    http2=True,
+    cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+)
+
+# Process-wide cap on the PACS fan-out requests (per-series instance lists, ZIP instance downloads).
+# List pages and ZIP downloads each keep their own per-request bound as well; this one keeps their
+# sum inside the pool with RESERVED_CONNECTIONS to spare, so excess requests queue here instead of
+# timing out on a pool slot (which surfaced as zero counts / dropped ZIP entries).
+pacs_fanout_slots = asyncio.Semaphore(MAX_CONNECTIONS - RESERVED_CONNECTIONS)
@@ -1,4 +1,5 @@
 import hashlib
+from functools import lru_cache
 from fastapi import Security, HTTPException, status
 from fastapi.security import APIKeyHeader
 from .config import SERVER_API_KEY, SECRET_PEPPER, API_KEY_NAME
@@ -18,9 +19,13 @@ async def get_api_key(api_key_header: str = Security(api_key_header)):
         detail="Could not validate credentials",
     )
 
+@lru_cache(maxsize=100_000)
 def hash_patient_id(original_id: str) -> str:
-    """Hashes the patient ID with a secret pepper."""
+    """Hashes the patient ID with a secret pepper (memoized, the pepper is fixed per process).
+    Same formula as the CLI anonymizer (anonym/anonym.py), so API and DICOM pseudonyms match."""
     if not original_id:
         return ""
+    if SECRET_PEPPER is None:
+        raise RuntimeError("SECRET_PEPPER is not configured")
     combined_string = str(original_id) + SECRET_PEPPER
     return hashlib.sha256(combined_string.encode('utf-8')).hexdigest()
@@ -1,24 +1,47 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from sqlalchemy.orm import Session, aliased, joinedload
+from sqlalchemy import desc, func
 from . import models
 
 # 1. Get a specific study by its ID (The "Select" part)
 def get_referral_by_study_id(db: Session, study_id: str):
     return db.query(models.Referral)\
+             .options(joinedload(models.Referral.study_descriptions))\
              .filter(models.Referral.study_id == study_id)\
              .first()
 
-# 2. Get all studies (The "Read all" part)
-# We use skip/limit for pagination so we don't crash the server with 100k rows
-def get_all_referrals(db: Session, skip: int = 0, limit: int = 100, min_status: int = None):
-    query = db.query(models.Referral)
+# 2. Get the studies that have descriptions, with their index
+# We use skip/limit for pagination so we don't crash the server with 100k rows. They page through
+# these referrals only; referrals without descriptions never leave the DB (EXISTS).
+# Passing after_id (the last id of the previous page) switches to keyset pagination: an index
+# range scan on the primary key instead of scanning and discarding OFFSET rows.
+# The index is the referral's 1-based position among ALL referrals ordered by id, which is what
+# the RIS study-by-index lookup expects. Returns (index, referral) rows.
+def get_referrals_with_descriptions(db: Session, skip: int = 0, limit: int = 100, after_id: int = None):
+    position = func.row_number().over(order_by=models.Referral.id)
+    if after_id is not None:
+        # Referrals up to the cursor still count towards the index (an index-only count)
+        preceding = db.query(func.count(models.Referral.id)) \
+            .filter(models.Referral.id <= after_id) \
+            .scalar_subquery()
+        position = position + preceding
 
-    if min_status is not None:
-        # Started (5), Saved (6), Signed (7)
-        query = query.filter(models.Referral.status > min_status)
+    numbered = db.query(
+        models.Referral.id,
+        models.Referral.study_id,
+        models.Referral.patient_id,
+        position.label("position"),
+        models.Referral.study_descriptions.any().label("has_descriptions"),
+    )
+    if after_id is not None:
+        numbered = numbered.filter(models.Referral.id > after_id)
+    numbered = numbered.subquery()
+    # Filtering outside the window keeps the numbering over all referrals; Postgres streams it
+    # in id order (index scan) and can stop at the LIMIT instead of numbering the whole table.
+    referral = aliased(models.Referral, numbered)
 
-
-    return query.order_by(models.Referral.id) \
+    return db.query(numbered.c.position, referral) \
+        .filter(numbered.c.has_descriptions) \
+        .order_by(numbered.c.id) \
         .offset(skip) \
         .limit(limit) \
         .all()
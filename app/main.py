@@ -1,7 +1,19 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+from .core.http import http_client
 from .routers import measurements, anonymization # Import the new routers
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await http_client.aclose()
+    anonymization.cpu_pool.shutdown(wait=False, cancel_futures=True)
+
+
+# orjson serializes the (dict-heavy) JSON responses instead of the stdlib encoder
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.include_router(measurements.router)
 app.include_router(anonymization.router)
@@ -10,8 +10,9 @@ class Referral(Base):
     study_id = Column(String)
     patient_id = Column(String, index=True)
 
-    # Relationship: One Referral has many StudyDescriptions
-    study_descriptions = relationship("StudyDescription", back_populates="referral")
+    # Relationship: One Referral has many StudyDescriptions.
+    # lazy="raise": queries must eager-load it (see crud), so an accidental N+1 fails loudly.
+    study_descriptions = relationship("StudyDescription", back_populates="referral", lazy="raise")
     status = Column(Integer)
     study_datetime = Column(DateTime, nullable=True)
 
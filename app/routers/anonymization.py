@@ -1,19 +1,28 @@
 import os
 import io
-import httpx
+import itertools
+import asyncio
+import concurrent.futures
 import pydicom
 import zipfile
 import json
 import hashlib
+import secrets
 import re
 import logging
+import multiprocessing
+import sys
 import base64
 from datetime import datetime
-from typing import Optional, List
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Optional, List, Mapping
 from fastapi import APIRouter, HTTPException, Header, Response, Request, Depends, Query
 from fastapi.responses import StreamingResponse
 from pydicom.uid import generate_uid, UID
 
+from ..core.config import PACS_PROXY_URL, RIS_API_URL, ANONYMIZER_HEADERS, INTERNAL_AUTH_SHARED_SECRET
+from ..core.http import http_client, pacs_fanout_slots
 from ..core.security import get_api_key
 
 router = APIRouter(prefix="/anonym", tags=["anonymization"])
@@ -21,48 +30,53 @@ logger = logging.getLogger("uvicorn")
 
 # --- Core Anonymization Engine ---
 
+# Replacement values for 'Z' actions, by VR
+VR_DEFAULTS = {
+    'DA': "", 'TM': "", 'DT': "",
+    'PN': "ANONYMIZED", 'AS': "000Y", 'CS': "U", 'DS': "0",
+    'IS': "0", 'LO': "ANONYMIZED", 'SH': "ANONYMIZED",
+    'ST': "ANONYMIZED", 'LT': "ANONYMIZED", 'UT': "ANONYMIZED", 'AE': "ANONYMIZED",
+}
+
+def _load_rules() -> Mapping[str, str]:
+    config_path = os.path.join(os.path.dirname(__file__), "..", "..", "anonym", "config", "dicom_ps3_15_profile.json")
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            # Interned so `keyword in RULES` against pydicom's keywords mostly hits the identity fast path
+            return MappingProxyType({sys.intern(k): sys.intern(v) for k, v in json.load(f).items()})
+    except Exception as e:
+        logger.error(f"Could not load anonymization config: {e}")
+        return MappingProxyType({})
+
+# Loaded once at import and shared read-only by every engine (and forked pool worker)
+RULES = _load_rules()
+
 class AnonymizerEngine:
-    def __init__(self):
-        self.rules = self._load_rules()
+    def __init__(self, uid_salt: Optional[str] = None):
+        self.rules = RULES
         self.pepper = os.getenv("PEPPER", "default_secret_pepper")
-        self.uid_map = {}
-
-    def _load_rules(self):
-        config_path = os.path.join(os.path.dirname(__file__), "..", "..", "anonym", "config", "dicom_ps3_15_profile.json")
-        try:
-            with open(config_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"Could not load anonymization config: {e}")
-            return {}
+        # Salts the derived replacement UIDs: stable for the engine's lifetime.
+        # Engines sharing a salt produce the same replacements (e.g. across pool workers).
+        self.uid_salt = uid_salt or secrets.token_hex(16)
 
     def _get_replacement_value(self, vr, action):
         if action == 'D': return ""
-        static_defaults = {
-            'DA': "", 'TM': "", 'DT': "",
-            'PN': "ANONYMIZED", 'AS': "000Y", 'CS': "U", 'DS': "0",
-            'IS': "0", 'LO': "ANONYMIZED", 'SH': "ANONYMIZED",
-            'ST': "ANONYMIZED", 'LT': "ANONYMIZED", 'UT': "ANONYMIZED", 'AE': "ANONYMIZED",
-        }
-        return generate_uid() if vr == 'UI' else static_defaults.get(vr, "ANONYMIZED")
+        return generate_uid() if vr == 'UI' else VR_DEFAULTS.get(vr, "ANONYMIZED")
 
     def _generate_consistent_uid(self, original_uid):
-        if original_uid not in self.uid_map:
-            self.uid_map[original_uid] = generate_uid()
-        return self.uid_map[original_uid]
+        # Derived instead of memoized, so the long-lived global engine no longer grows a map
+        h = hashlib.sha256((str(original_uid) + self.uid_salt).encode('utf-8')).hexdigest()
+        return '2.25.' + str(int(h[:32], 16))
 
     def _process_dataset_recursive(self, dataset):
-        try:
-            dataset.remove_private_tags()
-        except: pass
-
-        for elem in list(dataset):
+        removed = []
+        for elem in dataset:
             keyword = elem.keyword
             if not keyword: continue
 
             if elem.VR == 'SQ':
                 if keyword in self.rules and self.rules[keyword] == 'X':
-                    delattr(dataset, keyword)
+                    removed.append(elem.tag)
                 else:
                     for item in elem.value: 
                         self._process_dataset_recursive(item)
@@ -71,7 +85,7 @@ class AnonymizerEngine:
             if keyword in self.rules:
                 action = self.rules[keyword]
                 if action == 'X':
-                    delattr(dataset, keyword)
+                    removed.append(elem.tag)
                 elif action == 'U':
                     if elem.value:
                         if elem.VM > 1:
@@ -81,7 +95,14 @@ class AnonymizerEngine:
                 elif action in ['Z', 'D']:
                     elem.value = self._get_replacement_value(elem.VR, action)
 
+        for tag in removed:
+            del dataset[tag]
+
     def anonymize_dataset(self, ds, transfer_syntax=None):
+        # Once per dataset: pydicom walks into every sequence item itself
+        try:
+            ds.remove_private_tags()
+        except: pass
         self._process_dataset_recursive(ds)
         if not hasattr(ds, 'file_meta'):
             ds.file_meta = pydicom.dataset.FileMetaDataset()
@@ -100,8 +121,59 @@ class AnonymizerEngine:
 
 engine = AnonymizerEngine()
 
+# --- CPU Offloading ---
+
+# pydicom parsing/encoding is CPU-bound pure Python: run it in worker processes so it neither
+# blocks the event loop nor serializes on the GIL. Shut down by the lifespan handler in main.py.
+# Workers come from a forkserver, not fork(): the uvicorn process already runs threads (anyio's
+# threadpool), and a forked child can inherit one of their locks (e.g. logging's) held forever.
+def _new_cpu_pool() -> concurrent.futures.ProcessPoolExecutor:
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context("forkserver")
+    )
+
+cpu_pool = _new_cpu_pool()
+
+class AnonymizerUnavailable(Exception):
+    """The anonymizer did not run (worker pool failure). The data must not be sent un-anonymized."""
+
+@lru_cache(maxsize=8)
+def _engine_for_salt(uid_salt: str) -> AnonymizerEngine:
+    return AnonymizerEngine(uid_salt=uid_salt)
+
+def anonymize_dicom_bytes(raw_data: bytes, ts_uid: Optional[str], uid_salt: str) -> bytes:
+    """Parses, anonymizes and re-encodes one DICOM instance. Runs in cpu_pool."""
+    ds = pydicom.dcmread(io.BytesIO(raw_data), force=True)
+    ds = _engine_for_salt(uid_salt).anonymize_dataset(ds, transfer_syntax=ts_uid)
+    buf = io.BytesIO(); ds.save_as(buf, write_like_original=False)
+    return buf.getvalue()
+
+async def run_in_cpu_pool(func, *args):
+    global cpu_pool
+    pool = cpu_pool
+    try:
+        try:
+            future = asyncio.get_running_loop().run_in_executor(pool, func, *args)
+        except RuntimeError as e:
+            # Pool already shut down (app stopping)
+            raise AnonymizerUnavailable(str(e)) from e
+        return await future
+    except concurrent.futures.process.BrokenProcessPool as e:
+        # A dead worker (OOM kill, segfault) breaks the executor for good: replace it for the next
+        # requests, but this call's input was never anonymized.
+        if cpu_pool is pool:
+            logger.error("CPU pool broken, starting a new one")
+            cpu_pool = _new_cpu_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise AnonymizerUnavailable(str(e)) from e
+
 # --- Helpers ---
 
+# Upper bound on concurrent requests to the PACS proxy per ZIP download (all downloads together
+# are capped by pacs_fanout_slots)
+PACS_FETCH_CONCURRENCY = 16
+
 def extract_study_id(path: str) -> Optional[str]:
     match = re.search(r'studies/([^/]+)', path)
     return match.group(1).rstrip('/') if match else None
@@ -111,19 +183,15 @@ def extract_series_id(path: str) -> Optional[str]:
     return match.group(1).rstrip('/') if match else None
 
 async def get_internal_token(study_id: str) -> str:
-    ris_url = os.getenv('RIS_API_URL', "http://apiserver:8000/app/api")
-    akey = os.getenv('ANONYMIZER_API_KEY', "")
-    async with httpx.AsyncClient() as client:
-        res = await client.get(f"{ris_url}/referrals/study-by-uid/{study_id}/", headers={"X-Anonymizer-Key": akey})
-        if res.status_code != 200: raise HTTPException(status_code=res.status_code)
-        return res.json()['token']
+    res = await http_client.get(f"{RIS_API_URL}/referrals/study-by-uid/{study_id}/", headers=ANONYMIZER_HEADERS, timeout=5.0)
+    if res.status_code != 200: raise HTTPException(status_code=res.status_code)
+    return res.json()['token']
 
 def get_pacs_auth_headers(token: Optional[str] = None) -> dict:
     """Helper to construct authentication headers for the PACS proxy."""
     headers = {}
-    internal_secret = os.getenv("INTERNAL_AUTH_SHARED_SECRET")
-    if internal_secret:
-        headers["X-Internal-Secret"] = internal_secret
+    if INTERNAL_AUTH_SHARED_SECRET:
+        headers["X-Internal-Secret"] = INTERNAL_AUTH_SHARED_SECRET
     elif token:
         headers["Authorization"] = f"Bearer {token}"
     return headers
@@ -154,7 +222,7 @@ def clean_dicom_data(content: bytes, content_type: str) -> (bytes, Optional[str]
                     return body, parse_transfer_syntax(h_str)
     return content.strip(b'\r\n '), None
 
-def process_multipart_anonymously(content: bytes, content_type: str) -> bytes:
+def process_multipart_anonymously(content: bytes, content_type: str, uid_salt: str) -> bytes:
     match = re.search(r'boundary=([^;]+)', content_type)
     if not match: return content
     boundary = match.group(1).strip('"').encode()
@@ -173,120 +241,168 @@ def process_multipart_anonymously(content: bytes, content_type: str) -> bytes:
         ts_uid = parse_transfer_syntax(h_str)
         if "application/dicom" in h_str.lower() or b"DICM" in body[128:132] or b"DICM" in body[:4]:
             try:
-                ds = pydicom.dcmread(io.BytesIO(body), force=True)
-                ds = engine.anonymize_dataset(ds, transfer_syntax=ts_uid)
-                buf = io.BytesIO(); ds.save_as(buf, write_like_original=False); body = buf.getvalue()
+                body = anonymize_dicom_bytes(body, ts_uid, uid_salt)
             except Exception as e: logger.error(f"Part anonymization failed: {e}")
         new_parts.append(clean_part[:body_start] + body + b"\r\n")
     return b'--' + boundary + b'\r\n' + (b'--' + boundary + b'\r\n').join(new_parts) + b'--' + boundary + b'--\r\n'
 
-async def fetch_and_zip_series(proxy_url: str, study_id: str, series_id: str, token: Optional[str] = None):
-    buf = io.BytesIO()
-    file_count = 0
-    local_engine = AnonymizerEngine()
-    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-        auth_headers = get_pacs_auth_headers(token)
-        async with httpx.AsyncClient() as client:
-            list_url = f"{proxy_url.rstrip('/')}/studies/{study_id}/series/{series_id}/instances"
-            list_res = await client.get(list_url, headers={**auth_headers, "Accept": "application/dicom+json"}, timeout=20.0)
-            if list_res.status_code != 200: raise HTTPException(status_code=list_res.status_code)
-            instances = list_res.json()
-            def get_inst_num(x):
-                val = (x.get("00200013") or {}).get("Value", [0])[0]
-                try: return int(val)
-                except: return 0
-            instances.sort(key=get_inst_num)
-            for idx, inst in enumerate(instances):
-                iuid = (inst.get("00080018") or {}).get("Value", [None])[0] or \
-                       (inst.get("SOPInstanceUID") or {}).get("Value", [None])[0] or \
-                       inst.get("00080018") or inst.get("SOPInstanceUID")
-                if not iuid: continue
-                f_url = f"{proxy_url.rstrip('/')}/studies/{study_id}/series/{series_id}/instances/{iuid}"
-                try:
-                    f_res = await client.get(f_url, headers={**auth_headers, "Accept": "application/dicom, multipart/related"}, timeout=30.0)
-                    if f_res.status_code != 200: continue
-                    raw_data, ts_uid = clean_dicom_data(f_res.content, f_res.headers.get("content-type", ""))
-                    try:
-                        ds = pydicom.dcmread(io.BytesIO(raw_data), force=True)
-                        ds = local_engine.anonymize_dataset(ds, transfer_syntax=ts_uid)
-                        o = io.BytesIO(); ds.save_as(o, write_like_original=False)
-                        zf.writestr(f"IM_{idx+1:04d}.dcm", o.getvalue())
-                        file_count += 1
-                    except Exception as e:
-                        if b"DICM" in raw_data[128:132] or b"DICM" in raw_data[:4]:
-                            zf.writestr(f"IM_{idx+1:04d}.dcm", raw_data)
-                            file_count += 1
-                except Exception as e: logger.error(f"Error processing {iuid}: {e}")
-    return buf.getvalue()
+class ZipStreamBuffer:
+    """Write-only sink for ZipFile, drained after every entry so the archive can be streamed."""
 
-async def fetch_and_zip_study(proxy_url: str, study_id: str, token: Optional[str] = None):
-    buf = io.BytesIO()
-    local_engine = AnonymizerEngine()
-    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-        auth_headers = get_pacs_auth_headers(token)
-        async with httpx.AsyncClient() as client:
-            # 1. Get all series in the study
-            series_list_url = f"{proxy_url.rstrip('/')}/studies/{study_id}/series"
-            series_res = await client.get(series_list_url, headers={**auth_headers, "Accept": "application/dicom+json"}, timeout=20.0)
-            if series_res.status_code != 200: raise HTTPException(status_code=series_res.status_code)
-            series_json = series_res.json()
-            
-            # Sort series by SeriesNumber
-            def get_series_num(x):
-                val = (x.get("00200011") or {}).get("Value", [0])[0]
-                try: return int(val)
-                except: return 0
-            series_json.sort(key=get_series_num)
-
-            for s_idx, s_data in enumerate(series_json):
-                serid = (s_data.get("0020000E") or {}).get("Value", [None])[0]
-                s_num = get_series_num(s_data)
-                if not serid: continue
-                
-                # 2. Get all instances in this series
-                inst_list_url = f"{proxy_url.rstrip('/')}/studies/{study_id}/series/{serid}/instances"
-                inst_res = await client.get(inst_list_url, headers={**auth_headers, "Accept": "application/dicom+json"}, timeout=20.0)
-                if inst_res.status_code != 200: continue
-                instances = inst_res.json()
-                
-                # Sort instances by InstanceNumber
-                def get_inst_num(x):
-                    val = (x.get("00200013") or {}).get("Value", [0])[0]
-                    try: return int(val)
-                    except: return 0
-                instances.sort(key=get_inst_num)
-
-                for i_idx, inst in enumerate(instances):
-                    iuid = (inst.get("00080018") or {}).get("Value", [None])[0] or \
-                           (inst.get("SOPInstanceUID") or {}).get("Value", [None])[0]
-                    if not iuid: continue
-                    i_num = get_inst_num(inst)
-                    
-                    f_url = f"{proxy_url.rstrip('/')}/studies/{study_id}/series/{serid}/instances/{iuid}"
-                    try:
-                        f_res = await client.get(f_url, headers={**auth_headers, "Accept": "application/dicom, multipart/related"}, timeout=30.0)
-                        if f_res.status_code != 200: continue
-                        raw_data, ts_uid = clean_dicom_data(f_res.content, f_res.headers.get("content-type", ""))
-                        try:
-                            ds = pydicom.dcmread(io.BytesIO(raw_data), force=True)
-                            ds = local_engine.anonymize_dataset(ds, transfer_syntax=ts_uid)
-                            o = io.BytesIO(); ds.save_as(o, write_like_original=False)
-                            # Filename format: IM-XXXX-YYYY.dcm (XXXX=series, YYYY=instance)
-                            zf.writestr(f"IM-{s_num:04d}-{i_num:04d}.dcm", o.getvalue())
-                        except Exception:
-                            if b"DICM" in raw_data[128:132] or b"DICM" in raw_data[:4]:
-                                zf.writestr(f"IM-{s_num:04d}-{i_num:04d}.dcm", raw_data)
-                    except Exception as e: logger.error(f"Error processing {iuid}: {e}")
-    return buf.getvalue()
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def get_inst_num(x) -> int:
+    val = (x.get("00200013") or {}).get("Value", [0])[0]
+    try: return int(val)
+    except: return 0
+
+def get_series_num(x) -> int:
+    val = (x.get("00200011") or {}).get("Value", [0])[0]
+    try: return int(val)
+    except: return 0
+
+async def list_series_instances(proxy_url: str, study_id: str, series_id: str, token: Optional[str] = None) -> List[tuple]:
+    """Returns (archive name, instance URL) pairs for every instance of a series."""
+    auth_headers = get_pacs_auth_headers(token)
+    list_url = f"{proxy_url.rstrip('/')}/studies/{study_id}/series/{series_id}/instances"
+    list_res = await http_client.get(list_url, headers={**auth_headers, "Accept": "application/dicom+json"}, timeout=20.0)
+    if list_res.status_code != 200: raise HTTPException(status_code=list_res.status_code)
+    instances = list_res.json()
+    instances.sort(key=get_inst_num)
+
+    entries = []
+    for idx, inst in enumerate(instances):
+        iuid = (inst.get("00080018") or {}).get("Value", [None])[0] or \
+               (inst.get("SOPInstanceUID") or {}).get("Value", [None])[0] or \
+               inst.get("00080018") or inst.get("SOPInstanceUID")
+        if not iuid: continue
+        f_url = f"{proxy_url.rstrip('/')}/studies/{study_id}/series/{series_id}/instances/{iuid}"
+        entries.append((f"IM_{idx+1:04d}.dcm", f_url))
+    return entries
+
+async def list_study_instances(proxy_url: str, study_id: str, token: Optional[str] = None) -> List[tuple]:
+    """Returns (archive name, instance URL) pairs for every instance of a study."""
+    auth_headers = get_pacs_auth_headers(token)
+    # 1. Get all series in the study
+    series_list_url = f"{proxy_url.rstrip('/')}/studies/{study_id}/series"
+    series_res = await http_client.get(series_list_url, headers={**auth_headers, "Accept": "application/dicom+json"}, timeout=20.0)
+    if series_res.status_code != 200: raise HTTPException(status_code=series_res.status_code)
+    series_json = series_res.json()
+
+    # Sort series by SeriesNumber
+    series_json.sort(key=get_series_num)
+
+    sem = asyncio.Semaphore(PACS_FETCH_CONCURRENCY)
+
+    async def list_series(s_data) -> List[tuple]:
+        serid = (s_data.get("0020000E") or {}).get("Value", [None])[0]
+        s_num = get_series_num(s_data)
+        if not serid: return []
+
+        # 2. Get all instances in this series
+        inst_list_url = f"{proxy_url.rstrip('/')}/studies/{study_id}/series/{serid}/instances"
+        async with sem, pacs_fanout_slots:
+            inst_res = await http_client.get(inst_list_url, headers={**auth_headers, "Accept": "application/dicom+json"}, timeout=20.0)
+        if inst_res.status_code != 200: return []
+        instances = inst_res.json()
+
+        # Sort instances by InstanceNumber
+        instances.sort(key=get_inst_num)
+
+        series_entries = []
+        for inst in instances:
+            iuid = (inst.get("00080018") or {}).get("Value", [None])[0] or \
+                   (inst.get("SOPInstanceUID") or {}).get("Value", [None])[0]
+            if not iuid: continue
+            i_num = get_inst_num(inst)
+
+            f_url = f"{proxy_url.rstrip('/')}/studies/{study_id}/series/{serid}/instances/{iuid}"
+            # Filename format: IM-XXXX-YYYY.dcm (XXXX=series, YYYY=instance)
+            series_entries.append((f"IM-{s_num:04d}-{i_num:04d}.dcm", f_url))
+        return series_entries
+
+    # Series instance lists are fetched concurrently; gather keeps the series order
+    per_series = await asyncio.gather(*(list_series(s_data) for s_data in series_json))
+    return [entry for series_entries in per_series for entry in series_entries]
+
+async def fetch_anonymized_instance(f_url: str, auth_headers: dict, uid_salt: str) -> Optional[bytes]:
+    """Downloads one instance and returns its anonymized bytes (or the raw DICOM if it cannot be parsed).
+    Raises AnonymizerUnavailable when the anonymizer itself could not run."""
+    async with pacs_fanout_slots:
+        f_res = await http_client.get(f_url, headers={**auth_headers, "Accept": "application/dicom, multipart/related"}, timeout=30.0)
+    if f_res.status_code != 200: return None
+    raw_data, ts_uid = clean_dicom_data(f_res.content, f_res.headers.get("content-type", ""))
+    try:
+        return await run_in_cpu_pool(anonymize_dicom_bytes, raw_data, ts_uid, uid_salt)
+    except AnonymizerUnavailable:
+        raise
+    except Exception:
+        if b"DICM" in raw_data[128:132] or b"DICM" in raw_data[:4]:
+            return raw_data
+    return None
+
+async def stream_anonymized_zip(entries: List[tuple], token: Optional[str] = None):
+    """Yields a ZIP archive of the anonymized instances, one chunk per finished entry."""
+    buf = ZipStreamBuffer()
+    # One salt per archive: UIDs are consistent within the ZIP, whichever worker handles an instance
+    uid_salt = secrets.token_hex(16)
+    auth_headers = get_pacs_auth_headers(token)
+
+    async def fetch_one(arcname: str, f_url: str):
+        try:
+            return arcname, await fetch_anonymized_instance(f_url, auth_headers, uid_salt)
+        except Exception as e:
+            logger.error(f"Error processing {f_url}: {e}")
+            return arcname, None
+
+    # Bounded window: an entry holds its slot until it has been zipped and handed to the client,
+    # so a slow reader stalls the downloads instead of piling finished instances up in memory.
+    remaining = iter(entries)
+    pending = set()
+
+    def refill():
+        for arcname, f_url in itertools.islice(remaining, PACS_FETCH_CONCURRENCY - len(pending)):
+            pending.add(asyncio.ensure_future(fetch_one(arcname, f_url)))
+
+    refill()
+    try:
+        # DICOM pixel data is usually compressed already, DEFLATE would burn CPU for ~no gain
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    arcname, data = task.result()
+                    if data is None: continue
+                    zf.writestr(arcname, data)
+                    yield buf.drain()
+                refill()
+        # Central directory
+        yield buf.drain()
+    finally:
+        # Client went away mid-stream: stop the remaining downloads
+        for task in pending:
+            task.cancel()
 
 # --- Endpoints ---
 
 @router.get("/{path:path}")
 async def anonymize_proxy_path(path: str, request: Request, api_key: Optional[str] = Depends(get_api_key), accept: Optional[str] = Header(None)):
-    proxy_base_url = os.getenv('PACS_PROXY_URL', "http://pacs-proxy:8080")
     clean_path = path.rstrip('/')
     target_path = path[len("pacs/"):] if path.startswith("pacs/") else path
-    target_url = f"{proxy_base_url.rstrip('/')}/{target_path.lstrip('/')}"
+    target_url = f"{PACS_PROXY_URL}/{target_path.lstrip('/')}"
     
     logger.info(f"--- ANONYMIZE PROXY REQUEST ---")
     logger.info(f"Path: {path}")
@@ -300,17 +416,17 @@ async def anonymize_proxy_path(path: str, request: Request, api_key: Optional[st
         if sid and serid:
             logger.info(f"Detected ZIP request for series {serid} in study {sid}")
             try:
-                token = await get_internal_token(sid) if not os.getenv("INTERNAL_AUTH_SHARED_SECRET") else None
-                content = await fetch_and_zip_series(proxy_base_url, sid, serid, token)
-                return Response(content=content, media_type="application/zip", headers={"Content-Disposition": f"attachment; filename=series_{serid}.zip"})
+                token = await get_internal_token(sid) if not INTERNAL_AUTH_SHARED_SECRET else None
+                entries = await list_series_instances(PACS_PROXY_URL, sid, serid, token)
+                return StreamingResponse(stream_anonymized_zip(entries, token), media_type="application/zip", headers={"Content-Disposition": f"attachment; filename=series_{serid}.zip"})
             except Exception as e: 
                 logger.error(f"Series ZIP failed: {e}", exc_info=True)
         elif sid:
             logger.info(f"Detected ZIP request for full study {sid}")
             try:
-                token = await get_internal_token(sid) if not os.getenv("INTERNAL_AUTH_SHARED_SECRET") else None
-                content = await fetch_and_zip_study(proxy_base_url, sid, token)
-                return Response(content=content, media_type="application/zip", headers={"Content-Disposition": f"attachment; filename=study_{sid}.zip"})
+                token = await get_internal_token(sid) if not INTERNAL_AUTH_SHARED_SECRET else None
+                entries = await list_study_instances(PACS_PROXY_URL, sid, token)
+                return StreamingResponse(stream_anonymized_zip(entries, token), media_type="application/zip", headers={"Content-Disposition": f"attachment; filename=study_{sid}.zip"})
             except Exception as e:
                 logger.error(f"Study ZIP failed: {e}", exc_info=True)
 
@@ -328,10 +444,9 @@ async def anonymize_proxy_path(path: str, request: Request, api_key: Optional[st
 
     headers["Accept"] = 'application/dicom, multipart/related; type="application/dicom"'
     
-    internal_secret = os.getenv("INTERNAL_AUTH_SHARED_SECRET")
-    if internal_secret:
+    if INTERNAL_AUTH_SHARED_SECRET:
         logger.info("Using INTERNAL_AUTH_SHARED_SECRET for proxy authentication")
-        headers["X-Internal-Secret"] = internal_secret
+        headers["X-Internal-Secret"] = INTERNAL_AUTH_SHARED_SECRET
     elif api_key and not headers.get("authorization"):
         sid = extract_study_id(clean_path)
         if sid:
@@ -344,60 +459,59 @@ async def anonymize_proxy_path(path: str, request: Request, api_key: Optional[st
 
     logger.info(f"Outgoing Headers to Proxy: {list(headers.keys())}")
 
-    async with httpx.AsyncClient() as client:
-        try:
-            res = await client.get(target_url, headers=headers, params=request.query_params, follow_redirects=True, timeout=60.0)
-            logger.info(f"Proxy Response: {res.status_code}")
-            
-            if res.status_code != 200: 
-                logger.warning(f"Proxy returned non-200 status: {res.status_code}. Content: {res.content[:200]}")
-                return Response(content=res.content, status_code=res.status_code, media_type=res.headers.get("content-type"))
-            
-            c_type = res.headers.get("content-type", "")
-            logger.info(f"Proxy Content-Type: {c_type}")
-            
-            # Decide how to process based on content-type and requested path
-            if "multipart/related" in c_type:
-                # If it's a series request (doesn't contain "instances"), we SHOULD keep it multipart
-                # to include all 35 images.
-                if "instances" not in clean_path:
-                    logger.info("Processing series multipart response (anonymizing all parts)")
-                    content = process_multipart_anonymously(res.content, c_type)
-                    final_c_type = c_type
-                else:
-                    # If it's a single instance, try to flatten it to a raw DICOM binary
-                    logger.info("Flattening single-instance multipart to raw DICOM")
-                    raw_data, ts_uid = clean_dicom_data(res.content, c_type)
-                    try:
-                        ds = pydicom.dcmread(io.BytesIO(raw_data), force=True)
-                        ds = engine.anonymize_dataset(ds, transfer_syntax=ts_uid)
-                        buf = io.BytesIO(); ds.save_as(buf, write_like_original=False); content = buf.getvalue()
-                        final_c_type = "application/dicom"
-                    except: 
-                        content = raw_data
-                        final_c_type = "application/dicom"
+    try:
+        res = await http_client.get(target_url, headers=headers, params=request.query_params, follow_redirects=True, timeout=60.0)
+        logger.info(f"Proxy Response: {res.status_code}")
+        
+        if res.status_code != 200: 
+            logger.warning(f"Proxy returned non-200 status: {res.status_code}. Content: {res.content[:200]}")
+            return Response(content=res.content, status_code=res.status_code, media_type=res.headers.get("content-type"))
+        
+        c_type = res.headers.get("content-type", "")
+        logger.info(f"Proxy Content-Type: {c_type}")
+        
+        # Decide how to process based on content-type and requested path
+        if "multipart/related" in c_type:
+            # If it's a series request (doesn't contain "instances"), we SHOULD keep it multipart
+            # to include all 35 images.
+            if "instances" not in clean_path:
+                logger.info("Processing series multipart response (anonymizing all parts)")
+                content = await run_in_cpu_pool(process_multipart_anonymously, res.content, c_type, engine.uid_salt)
+                final_c_type = c_type
             else:
-                # Standard non-multipart response
+                # If it's a single instance, try to flatten it to a raw DICOM binary
+                logger.info("Flattening single-instance multipart to raw DICOM")
                 raw_data, ts_uid = clean_dicom_data(res.content, c_type)
-                if b"DICM" in raw_data[128:132] or b"DICM" in raw_data[:4] or "application/dicom" in c_type:
-                    try:
-                        logger.info("Anonymizing single DICOM instance (non-multipart)")
-                        ds = pydicom.dcmread(io.BytesIO(raw_data), force=True)
-                        ds = engine.anonymize_dataset(ds, transfer_syntax=ts_uid)
-                        buf = io.BytesIO(); ds.save_as(buf, write_like_original=False); content = buf.getvalue()
-                        final_c_type = "application/dicom"
-                    except: 
-                        content = raw_data
-                        final_c_type = "application/dicom"
-                else: 
-                    logger.info("Returning non-DICOM content as-is")
+                try:
+                    content = await run_in_cpu_pool(anonymize_dicom_bytes, raw_data, ts_uid, engine.uid_salt)
+                    final_c_type = "application/dicom"
+                except AnonymizerUnavailable:
+                    raise
+                except Exception: 
+                    content = raw_data
+                    final_c_type = "application/dicom"
+        else:
+            # Standard non-multipart response
+            raw_data, ts_uid = clean_dicom_data(res.content, c_type)
+            if b"DICM" in raw_data[128:132] or b"DICM" in raw_data[:4] or "application/dicom" in c_type:
+                try:
+                    logger.info("Anonymizing single DICOM instance (non-multipart)")
+                    content = await run_in_cpu_pool(anonymize_dicom_bytes, raw_data, ts_uid, engine.uid_salt)
+                    final_c_type = "application/dicom"
+                except AnonymizerUnavailable:
+                    raise
+                except Exception: 
                     content = raw_data
-                    final_c_type = c_type
-            
-            return Response(content=content, media_type=final_c_type)
-        except Exception as e: 
-            logger.error(f"Proxy request failed: {e}", exc_info=True)
-            raise HTTPException(status_code=500, detail=str(e))
+                    final_c_type = "application/dicom"
+            else: 
+                logger.info("Returning non-DICOM content as-is")
+                content = raw_data
+                final_c_type = c_type
+        
+        return Response(content=content, media_type=final_c_type)
+    except Exception as e: 
+        logger.error(f"Proxy request failed: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/series/{study_id}/{series_id}")
 async def anonymize_series_direct(
@@ -408,16 +522,16 @@ async def anonymize_series_direct(
     base64_encode: bool = Query(False, alias="base64"),
     x_base64_encode: Optional[str] = Header(None)
 ):
-    token = x_iot_token or (await get_internal_token(study_id) if api_key and not os.getenv("INTERNAL_AUTH_SHARED_SECRET") else None)
-    proxy_url = os.getenv('PACS_PROXY_URL', "http://pacs-proxy:8080")
-    content = await fetch_and_zip_series(proxy_url, study_id, series_id, token)
+    token = x_iot_token or (await get_internal_token(study_id) if api_key and not INTERNAL_AUTH_SHARED_SECRET else None)
+    entries = await list_series_instances(PACS_PROXY_URL, study_id, series_id, token)
     
     # Check if Base64 is requested via Query Param OR Header
     is_base64_requested = base64_encode or (x_base64_encode and x_base64_encode.lower() == "true")
     
     if is_base64_requested:
         logger.info(f"Encoding ZIP series {series_id} as Base64 text (requested via header/query)")
+        content = b"".join([chunk async for chunk in stream_anonymized_zip(entries, token)])
         b64_content = base64.b64encode(content).decode('utf-8')
         return Response(content=b64_content, media_type="text/plain")
         
-    return Response(content=content, media_type="application/zip", headers={"Content-Disposition": f"attachment; filename=series_{serid}.zip" if 'serid' in locals() else f"attachment; filename=series_{series_id}.zip"})
+    return StreamingResponse(stream_anonymized_zip(entries, token), media_type="application/zip", headers={"Content-Disposition": f"attachment; filename=series_{series_id}.zip"})
@@ -1,13 +1,17 @@
-import os
+import asyncio
 import httpx
 import logging
-from typing import List
+import orjson
+from cachetools import TTLCache
+from typing import Dict, List, Optional
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from sqlalchemy.orm import Session
 from .. import schemas, crud, database
 
+from ..core.http import http_client, pacs_fanout_slots
 from ..core.security import get_api_key, hash_patient_id
-from ..core.config import STATUS_SIGNED, STATUS_STARTED
+from ..core.config import STATUS_SIGNED, STATUS_STARTED, PACS_PROXY_URL, RIS_API_URL, ANONYMIZER_HEADERS, RIS_BULK_TOKENS
 
 router = APIRouter(
     prefix="/measurements",
@@ -17,110 +21,247 @@ router = APIRouter(
 
 logger = logging.getLogger("uvicorn")
 
+# Max concurrent PACS requests per study (all studies together are capped by pacs_fanout_slots)
+PACS_FETCH_CONCURRENCY = 16
+# Max referrals of a list page resolved (RIS token + PACS counts) at the same time
+REFERRAL_CONCURRENCY = 8
+# DICOM JSON key of SeriesInstanceUID
+SERIES_UID_TAG = "0020000E"
+
+# study_id -> (series_len, instance_len). Counts of a study rarely change once it is stored,
+# so repeated list polls skip the PACS fan-out; failed lookups are never cached.
+_pacs_cache = TTLCache(maxsize=10_000, ttl=300)
+
+# (skip, limit, after_id) -> (serialized list page, its next cursor). Referrals are written by the RIS (Django), not here,
+# so there is no write path to invalidate from: the short TTL bounds how stale a page can be.
+_page_cache = TTLCache(maxsize=256, ttl=30)
+
 async def get_pacs_counts(study_id: str, iot_token: str):
-    proxy_url = os.getenv('PACS_PROXY_URL')
+    """Returns (series_len, instance_len, complete); complete is False when any PACS lookup failed."""
+    cached = _pacs_cache.get(study_id)
+    if cached is not None:
+        return (*cached, True)
+
     headers = {"Authorization": f"Bearer {iot_token}"}
-    logger.info(f"DEBUG: Starting get_pacs_counts for {study_id} using proxy {proxy_url}")
+    logger.debug("Starting get_pacs_counts for %s using proxy %s", study_id, PACS_PROXY_URL)
     
-    async with httpx.AsyncClient() as client:
-        try:
-            # Get series
-            series_res = await client.get(f"{proxy_url}/studies/{study_id}/series", headers=headers, timeout=10.0)
-            logger.info(f"DEBUG: Series response for {study_id}: {series_res.status_code}")
-            
-            if series_res.status_code != 200:
-                logger.error(f"PACS Series Error: {series_res.status_code} Body: {series_res.text[:100]}")
-                return 0, []
-            
-            series_list = series_res.json()
-            series_len = len(series_list)
-            instance_len = []
-            
-            logger.info(f"DEBUG: Found {series_len} series for study {study_id}")
+    try:
+        # Get series
+        series_res = await http_client.get(f"{PACS_PROXY_URL}/studies/{study_id}/series", headers=headers, timeout=10.0)
+        logger.debug("Series response for %s: %s", study_id, series_res.status_code)
+        
+        if series_res.status_code != 200:
+            logger.error(f"PACS Series Error: {series_res.status_code} Body: {series_res.text[:100]}")
+            return 0, [], False
+        
+        series_list = series_res.json()
+        series_len = len(series_list)
+        
+        logger.debug("Found %s series for study %s", series_len, study_id)
+        
+        sem = asyncio.Semaphore(PACS_FETCH_CONCURRENCY)
+        series_url = f"{PACS_PROXY_URL}/studies/{study_id}/series/"
+        # Series whose /instances lookup failed; their 0 counts must not be cached
+        failed = []
+
+        async def count_instances(idx, series):
+            try:
+                series_uid = series[SERIES_UID_TAG]["Value"][0]
+            except (KeyError, IndexError):
+                # No UID to ask for: the series is still listed, with no instances
+                logger.error(f"PACS series {idx} of {study_id} has no SeriesInstanceUID")
+                return schemas.SeriesInstanceCount(series_index=idx, instance_count=0)
+            logger.debug("Fetching instances for series %s: %s", idx, series_uid)
             
-            for idx, series in enumerate(series_list, 1):
-                series_uid = series.get("0020000E", {}).get("Value", [""])[0]
-                logger.info(f"DEBUG: Fetching instances for series {idx}: {series_uid}")
-                
-                instances_res = await client.get(
-                    f"{proxy_url}/studies/{study_id}/series/{series_uid}/instances", 
+            async with sem, pacs_fanout_slots:
+                instances_res = await http_client.get(
+                    series_url + series_uid + "/instances", 
                     headers=headers,
                     timeout=10.0
                 )
-                
-                if instances_res.status_code == 200:
-                    instances = instances_res.json()
-                    count = len(instances)
-                    logger.info(f"DEBUG: Series {idx} returned {count} instances.")
-                else:
-                    logger.error(f"PACS Instance Error for series {idx}: {instances_res.status_code}")
-                    count = 0
-                
-                instance_len.append(schemas.SeriesInstanceCount(series_index=idx, instance_count=count))
-                
-            return series_len, instance_len
-        except Exception as e:
-            logger.error(f"get_pacs_counts CRITICAL exception: {str(e)}")
-            return 0, []
+            
+            if instances_res.status_code == 200:
+                instances = instances_res.json()
+                count = len(instances)
+                logger.debug("Series %s returned %s instances.", idx, count)
+            else:
+                logger.error(f"PACS Instance Error for series {idx}: {instances_res.status_code}")
+                failed.append(idx)
+                count = 0
+            
+            return schemas.SeriesInstanceCount(series_index=idx, instance_count=count)
+
+        # All series at once (bounded), results keep the series order.
+        # Every request settles before returning; a failure still fails the whole study.
+        instance_len = await asyncio.gather(
+            *(count_instances(idx, series) for idx, series in enumerate(series_list, 1)),
+            return_exceptions=True
+        )
+        for result in instance_len:
+            if isinstance(result, BaseException):
+                raise result
+            
+        if not failed:
+            _pacs_cache[study_id] = series_len, instance_len
+        return series_len, instance_len, not failed
+    except Exception as e:
+        logger.error(f"get_pacs_counts CRITICAL exception: {str(e)}")
+        return 0, [], False
+
+async def fetch_ris_tokens(ris_url: str, indices: List[int]) -> Optional[Dict[int, str]]:
+    """Fetches the IOT tokens of a whole page in one RIS call. None if the bulk endpoint is unavailable."""
+    if not RIS_BULK_TOKENS:
+        return None
+    if not indices:
+        return {}
+    try:
+        res = await http_client.get(
+            f"{ris_url}/referrals/tokens/",
+            params={"indices": ",".join(map(str, indices))},
+            headers=ANONYMIZER_HEADERS,
+            timeout=5.0
+        )
+    except httpx.HTTPError as e:
+        logger.error(f"RIS bulk token request failed: {str(e)}")
+        return None
+    if res.status_code != 200:
+        logger.error(f"RIS bulk tokens unavailable ({res.status_code}), using per-index lookups")
+        return None
+    try:
+        return {int(i): str(token) for i, token in res.json().items()}
+    except (ValueError, TypeError, AttributeError) as e:
+        # Not a {index: token} object (HTML error page, list, non-numeric keys...)
+        logger.error(f"RIS bulk tokens: unexpected response ({str(e)}), using per-index lookups")
+        return None
+
+def _cursor_headers(next_after_id: Optional[int]) -> dict:
+    return {"X-Next-After-Id": str(next_after_id)} if next_after_id is not None else {}
+
+async def stream_summaries(tasks: List[asyncio.Future], cache_key: Optional[tuple] = None, next_after_id: Optional[int] = None):
+    """Yields a JSON array of the summaries, one element per finished task (completion order).
+    Tasks return (summary, complete). A fully sent array with no omitted or degraded entries
+    is stored in the page cache under cache_key."""
+    chunks = []
+    complete = True
+    try:
+        sep = b"["
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                summary, summary_complete = await next_done
+            except Exception as e:
+                # The 200 is already on the wire: leave the entry out rather than truncate the array
+                logger.error(f"Summary failed, omitted from the list: {str(e)}")
+                complete = False
+                continue
+            complete = complete and summary_complete
+            chunks.append(sep + orjson.dumps(summary.model_dump()))
+            yield chunks[-1]
+            sep = b","
+        chunks.append(b"[]" if sep == b"[" else b"]")
+        yield chunks[-1]
+        if cache_key is not None and complete:
+            _page_cache[cache_key] = b"".join(chunks), next_after_id
+    finally:
+        # Client went away mid-stream: stop the remaining lookups
+        for task in tasks:
+            task.cancel()
 
 # --- Endpoint 1: Read All ---
 @router.get("/", response_model=List[schemas.StudySummary])
 async def list_measurements(
         skip: int = 0,
         limit: int = Query(default=25, le=1000),
+        after_id: Optional[int] = None,
         db: Session = Depends(database.get_db)
 ):
+    # after_id: keyset cursor, the X-Next-After-Id of the previous page (skip then counts from there)
+    cache_key = (skip, limit, after_id)
+    cached = _page_cache.get(cache_key)
+    if cached is not None:
+        body, next_after_id = cached
+        return Response(content=body, media_type="application/json", headers=_cursor_headers(next_after_id))
+
     # Temporarily RELAX filters to see what's happening
-    referrals = crud.get_all_referrals(db, skip=skip, limit=limit)
+    referrals = crud.get_referrals_with_descriptions(db, skip=skip, limit=limit, after_id=after_id)
+    next_after_id = referrals[-1][1].id if referrals else None
     
-    # ris_url = os.getenv('RIS_API_URL', "").rstrip('/')
-    ris_url = "http://apiserver:8000/app/api"
-    anonymizer_key = os.getenv('ANONYMIZER_API_KEY', "")
+    ris_url = RIS_API_URL
 
-    logger.info(f"DEBUG: Starting measurements sync. RIS_URL={ris_url}")
+    logger.debug("Starting measurements sync. RIS_URL=%s", ris_url)
     
     if not ris_url:
         raise HTTPException(status_code=500, detail="RIS_API_URL not configured")
 
-    results = []
-    logger.info(f"DEBUG: Processing {len(referrals)} referrals from DB")
-
-    for i, ref in enumerate(referrals, start=skip + 1):
-        has_desc = len(ref.study_descriptions) > 0
-        if has_desc:
-            async with httpx.AsyncClient() as client:
-                # Construct URL carefully
-                target_url = f"{ris_url}/referrals/study-by-index/{i}/"
-                logger.info(f"DEBUG: Fetching token from: {target_url}")
-                ris_res = await client.get(
-                    target_url,
-                    headers={"X-Anonymizer-Key": anonymizer_key},
-                    timeout=5.0
-                )
-                
-                if ris_res.status_code == 200:
-                    data = ris_res.json()
-                    iot_token = data['token']
-                    series_len, instance_len = await get_pacs_counts(ref.study_id, iot_token)
-                    
-                    results.append(schemas.StudySummary(
-                        index=i,
-                        study_id=ref.study_id,
-                        patient_id=hash_patient_id(ref.patient_id),
-                        series_len=series_len,
-                        instance_len=instance_len
-                    ))
+    logger.debug("Processing %s referrals from DB", len(referrals))
+
+    # One round-trip for the whole page when RIS_BULK_TOKENS is on; otherwise (or if it fails) one call per index
+    tokens = await fetch_ris_tokens(ris_url, [i for i, _ in referrals])
+
+    sem = asyncio.Semaphore(REFERRAL_CONCURRENCY)
+
+    async def fetch_token(i):
+        # Construct URL carefully
+        target_url = f"{ris_url}/referrals/study-by-index/{i}/"
+        logger.debug("Fetching token from: %s", target_url)
+        ris_res = await http_client.get(
+            target_url,
+            headers=ANONYMIZER_HEADERS,
+            timeout=5.0
+        )
+        if ris_res.status_code != 200:
+            logger.error(f"RIS Token Error: {ris_res.status_code} for index {i}")
+            return None
+        return ris_res.json()['token']
+
+    async def process_ref(i, ref, patient_id):
+        async with sem:
+            # Runs after the response has started: failures degrade to a summary without PACS counts
+            try:
+                if tokens is None:
+                    iot_token = await fetch_token(i)
                 else:
-                    logger.error(f"RIS Token Error: {ris_res.status_code} for index {i}")
-                    # Still add it without PACS counts if token fails
-                    results.append(schemas.StudySummary(
-                        index=i,
-                        study_id=ref.study_id,
-                        patient_id=hash_patient_id(ref.patient_id),
-                        series_len=0,
-                        instance_len=[]
-                    ))
-    return results
+                    iot_token = tokens.get(i)
+                    if iot_token is None:
+                        logger.error(f"RIS Token Error: no token for index {i}")
+            except Exception as e:
+                logger.error(f"RIS Token Error: {str(e)} for index {i}")
+                iot_token = None
+            
+            if iot_token is not None:
+                series_len, instance_len, complete = await get_pacs_counts(ref.study_id, iot_token)
+                
+                return schemas.StudySummary(
+                    index=i,
+                    study_id=ref.study_id,
+                    patient_id=patient_id,
+                    series_len=series_len,
+                    instance_len=instance_len
+                ), complete
+            else:
+                # Still add it without PACS counts if token fails
+                return schemas.StudySummary(
+                    index=i,
+                    study_id=ref.study_id,
+                    patient_id=patient_id,
+                    series_len=0,
+                    instance_len=[]
+                ), False
+
+    # Referrals are resolved concurrently (bounded) and each summary is sent as soon as it is ready,
+    # so the client gets the first bytes without waiting for the slowest lookup. The serialized
+    # chunks are also kept to fill the page cache, so the encoded page (not its models) does stay
+    # in memory until the stream ends. Clients sort by "index" if they need page order.
+    # Hashed before streaming starts, so a pepper misconfiguration is still a 500
+    patient_ids = [hash_patient_id(ref.patient_id) for _, ref in referrals]
+    tasks = [
+        asyncio.ensure_future(process_ref(i, ref, patient_id))
+        for (i, ref), patient_id in zip(referrals, patient_ids)
+    ]
+    return StreamingResponse(
+        stream_summaries(tasks, cache_key=cache_key, next_after_id=next_after_id),
+        media_type="application/json",
+        headers=_cursor_headers(next_after_id)
+    )
 
 
 # --- Endpoint 2: Detail View ---
@@ -133,16 +274,15 @@ def get_measurement_details(study_id: str, db: Session = Depends(database.get_db
 
     hashed_id = hash_patient_id(ref.patient_id)
 
+    # The measurements are JSON straight from the DB: serialize them without building/validating models
     if not ref.study_descriptions:
-        return [schemas.SimpleStudyResponse(
-            patient_id=hashed_id,
-            measurements=[]
-        )]
-
-    return [
-        schemas.SimpleStudyResponse(
-            patient_id=hashed_id,
-            measurements=desc.measurements or []
+        # Nothing measured yet: clients poll this, let them reuse the answer for a few seconds
+        return ORJSONResponse(
+            [{"patient_id": hashed_id, "measurements": []}],
+            headers={"Cache-Control": "private, max-age=10"}
         )
+
+    return ORJSONResponse([
+        {"patient_id": hashed_id, "measurements": desc.measurements or []}
         for desc in ref.study_descriptions
-    ]
+    ])
@@ -1,13 +1,12 @@
 from typing import List, Optional, Any
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 # --- Shared Base ---
 class MeasurementBase(BaseModel):
     description_id: int
     description_text: Optional[str]
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 # --- 1. Summary Schema (Lightweight list) ---
 class SeriesInstanceCount(BaseModel):
@@ -21,8 +20,7 @@ class StudySummary(BaseModel):
     series_len: int           # Number of series
     instance_len: List[SeriesInstanceCount] # Instances per series
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 # --- 2. Detail Schema (Full Data) ---
 class StudyDetail(StudySummary):
@@ -32,5 +30,4 @@ class SimpleStudyResponse(BaseModel):
     patient_id: str
     measurements: Any  # This will hold the JSON list from the DB
 
-    class Config:
-        orm_mode = True
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file